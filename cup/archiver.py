@@ -9,45 +9,116 @@ info -- Get information about the files in an archive.
 
 from pathlib import Path
 from os import PathLike
-from typing import BinaryIO, Union, List, Tuple
+from typing import BinaryIO, ContextManager, Optional, Union, List, Tuple, Dict, Iterable, Iterator
+from collections import deque
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, FIRST_EXCEPTION
+from operator import attrgetter
+import errno
+import functools
 import logging
-
+import os
+import stat
+import struct
+import sys
+import threading
+import zlib
+
+from . import directio
 from .fileheader import FileHeader
 from .exceptions import *
 
-CHUNK_SIZE = 4096
+logger = logging.getLogger(__name__)
+
+# size of the chunks in which file contents are copied, can be tuned with the CUP_CHUNK_SIZE environment variable
+DEFAULT_CHUNK_SIZE = 1 << 20
 FILE_SIGNATURE = b'__C__U__P__'
+CHECKSUMS_SIGNATURE = b'__C__R__C__'
+# os.sendfile only accepts regular files as the output on Linux
+_USE_SENDFILE = sys.platform.startswith('linux') and hasattr(os, 'sendfile')
+# os.copy_file_range lets the file system share or copy the data without going through the page cache
+_USE_COPY_FILE_RANGE = _USE_SENDFILE and hasattr(os, 'copy_file_range')
+# number of files for which reading is requested ahead of the file being copied
+READAHEAD_DEPTH = 64
+# maximum number of threads extracting files at the same time when unpacking, the extraction waits on I/O most
+# of the time so there are more threads than processors, like the default of ThreadPoolExecutor
+UNPACK_MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# minimum number of files for which unpacking uses threads, below it starting them costs more than it saves
+UNPACK_CONCURRENCY_THRESHOLD = 5
+# maximum number of threads scanning directories at the same time when packing
+WALK_MAX_WORKERS = UNPACK_MAX_WORKERS
+# number of directories waiting to be scanned above which packing scans them using threads
+WALK_CONCURRENCY_THRESHOLD = 4
+# number of archives whose file headers are kept in memory after being read
+HEADER_CACHE_SIZE = 16
+# size below which files are copied through the page cache even with direct I/O, for them the aligned buffer and
+# reads cost more than going through the page cache
+DIRECT_MIN_FILE_SIZE = directio.BUFFER_SIZE
+# lock for reading at an offset of a file on platforms without positional reads
+_SEEK_LOCK = threading.Lock()
+
+
+def _chunk_size_from_environment() -> int:
+    """Internal function.
+
+    Used for setting CHUNK_SIZE, reads the chunk size in bytes from the CUP_CHUNK_SIZE environment variable,
+    falling back to DEFAULT_CHUNK_SIZE if it isn't set or isn't a positive integer.
+
+    :return: Chunk size in bytes.
+    """
+    chunk_size = os.environ.get('CUP_CHUNK_SIZE')
+    if chunk_size is None:
+        return DEFAULT_CHUNK_SIZE
+    try:
+        chunk_size = int(chunk_size)
+    except ValueError:
+        chunk_size = 0
+    if chunk_size <= 0:
+        logger.warning('invalid CUP_CHUNK_SIZE %r, using %d', os.environ['CUP_CHUNK_SIZE'], DEFAULT_CHUNK_SIZE)
+        return DEFAULT_CHUNK_SIZE
+    return chunk_size
+
+
+CHUNK_SIZE = _chunk_size_from_environment()
 
 
 def pack(*paths: Union[str, bytes, PathLike],
-         archive_name: Union[str, bytes, PathLike] = 'archive.cup') -> None:
+         archive_name: Union[str, bytes, PathLike] = 'archive.cup',
+         direct: bool = False) -> None:
     """Pack files/directories into an archive.
 
     The files/directories specified in the *paths* variable length argument are
     packed into an archive with the name specified by the *archive_name* keyword argument.
     Only the basename of the specified files in *paths* will be kept. If a path to a directory is passed
     then the basename of it will be kept and all the other files inside it will have the path relative to
-    the directory.
+    the directory. A CRC-32 checksum of every file is stored in the archive. Setting *direct* reads the files and
+    writes the archive with direct I/O, bypassing the page cache, which is faster for files larger than the
+    available memory. Files smaller than DIRECT_MIN_FILE_SIZE are still read through the page cache.
 
     :param paths: Variable length argument that specifies a list of files or directories to be added to the archive.
     :param archive_name: Name of the archive where all files will be added.
+    :param direct: Whether to use direct I/O.
     """
     file_header_list, file_path_list = _header_path_list_from_paths(*paths)
-    if Path(os.path.abspath(archive_name)) in file_path_list:
+    if os.fsdecode(os.path.abspath(archive_name)) in file_path_list:
         raise ArchiveAlreadyExistsError(archive_name)
 
-    logging.info(f'packing {paths} to {archive_name}...')
-    with open(archive_name, 'wb') as archive:
-        # Write file signature
-        archive.write(FILE_SIGNATURE)
-
-        for file_header in file_header_list:
-            archive.write(file_header.header_array)
-        for path in file_path_list:
-            with open(path, 'rb') as file:
-                while chunk := file.read(CHUNK_SIZE):
-                    archive.write(chunk)
-    logging.info(f'packed {paths} to {archive_name}')
+    direct = _resolve_direct(direct)
+    logger.info('packing %s to %s...', paths, archive_name)
+    # The modification time of a rewritten archive may not differ from the cached one on coarse clocks
+    _read_header_list.cache_clear()
+    # the buffer of the archive file object gathers the contents of small files into larger writes
+    archive = directio.open_for_writing(archive_name) if direct else open(archive_name, 'wb', buffering=CHUNK_SIZE)
+    try:
+        with archive:
+            _write_archive(archive, file_header_list, file_path_list, direct)
+    except BaseException:
+        # The archive has its final size from the start, a partly written one would look complete but for its
+        # checksums table, so it is removed
+        with contextlib.suppress(OSError):
+            os.unlink(archive_name)
+        raise
+    logger.info('packed %s to %s', paths, archive_name)
 
 
 def info(archive_path: Union[str, bytes, PathLike]) -> List[Tuple[int, int, int, str]]:
@@ -62,114 +133,357 @@ def info(archive_path: Union[str, bytes, PathLike]) -> List[Tuple[int, int, int,
     """
     file_header_list = _header_list_from_archive(archive_path)
 
-    file_info_list = []
-    for index, fh in enumerate(file_header_list):
-        file_info_list.append((index, fh.file_size, fh.file_timestamp, fh.file_path))
-    logging.info(f'gathered info for {archive_path}')
+    file_info_list = [(index, fh.file_size, fh.file_timestamp, fh.file_path)
+                      for index, fh in enumerate(file_header_list)]
+    logger.info('gathered info for %s', archive_path)
     return file_info_list
 
 
 def unpack(*renaming: Tuple[Union[int, str], str],
            archive_path: Union[str, bytes, PathLike],
-           destination_path: Union[str, bytes, PathLike]) -> None:
+           destination_path: Union[str, bytes, PathLike],
+           direct: bool = False,
+           verify: bool = True) -> None:
     """Unpack the archive.
 
     Unpacks the archive specified by the *archive_path* argument into the destination path specified
     by the *destination_path* argument. The *renaming* variable length argument consists of tuples of the form
-    (old file name in archive, new file name).
+    (old file name in archive or its index as returned by info, new file name). Setting *direct* reads the archive
+    and writes the files with direct I/O, bypassing the page cache, except for the files smaller than
+    DIRECT_MIN_FILE_SIZE. With *verify* set, the contents of every file
+    are checked against the checksum stored in the archive, if the archive has checksums.
 
     :param renaming: Optional variable length argument specifying renaming of files.
     :param archive_path: Path of the archive to unpack.
     :param destination_path: Path where the archive will be unpacked.
+    :param direct: Whether to use direct I/O.
+    :param verify: Whether to verify the checksums of the files.
     """
     archive_path = Path(archive_path).resolve()
+    destination_path = Path(destination_path)
     file_header_list = _header_list_from_archive(archive_path)
-    previous_working_directory = os.getcwd()
 
     _create_destination_path(destination_path)
 
     if renaming:
-        renaming = {original_name: changed_name for original_name, changed_name in renaming}
-        file_header_list = filter(lambda fh: fh.file_path in renaming.keys(), file_header_list)
-        file_header_list = list(map(lambda fh: fh.with_different_path(renaming[fh.file_path]), file_header_list))
+        renaming = _resolve_renaming(renaming, file_header_list)
+        file_header_list = [fh.with_different_path(renaming[fh.file_path])
+                            for fh in file_header_list if fh.file_path in renaming]
+
+    # Files unpacked to the same path would be written at the same time by different threads, only the last one
+    # is kept, the one which unpacking them in order would leave on disk
+    file_header_list = list({os.path.normpath(fh.file_path): fh for fh in file_header_list}.values())
+
+    direct = _resolve_direct(direct)
+    logger.info('unpacking %s to %s...', archive_path, destination_path)
+    # Create the directories beforehand so that concurrent extractions don't race on creating the same ones
+    _create_directories(destination_path, file_header_list)
+    # Extract the files in the order of their contents in the archive, so the archive is read front to back
+    file_header_list = sorted(file_header_list, key=attrgetter('file_offset'))
+    with open(archive_path, 'rb') as archive, _open_direct_archive(archive_path, direct) as direct_archive:
+        if len(file_header_list) >= UNPACK_CONCURRENCY_THRESHOLD:
+            _unpack_files_concurrently(file_header_list, archive, destination_path, direct_archive, verify)
+        else:
+            # reading ahead would fill the page cache that direct I/O bypasses
+            for file_header in file_header_list if direct else _with_archive_readahead(archive, file_header_list):
+                _unpack_file(file_header, archive, destination_path, direct_archive, verify)
+    logger.info('unpacked %s to %s', archive_path, destination_path)
 
-    os.chdir(destination_path)
-    logging.info(f'unpacking {archive_path} to {destination_path}...')
-    with open(archive_path, 'rb') as archive:
-        for file_header in file_header_list:
-            _create_file_path(file_header.file_path)
-            _unpack_file(file_header, archive)
-    os.chdir(previous_working_directory)
-    logging.info(f'unpacked {archive_path} to {destination_path}')
+
+def _write_archive(archive: BinaryIO,
+                   file_header_list: List[FileHeader],
+                   file_path_list: List[str],
+                   direct: bool) -> None:
+    """Internal function.
+
+    Used when packing an archive, writes the file signature, the file headers, the contents of the files and the
+    checksums table to the archive.
+
+    :param archive: Archive file object, opened for writing.
+    :param file_header_list: File headers of the files to pack, with their offsets set.
+    :param file_path_list: Paths to the files to pack, in the order of the file headers.
+    :param direct: Whether to use direct I/O, in which case *archive* must be opened with direct I/O.
+    :raises ResourceChangedError: If a file got shorter since its file header was created.
+    """
+    # Reserve the space of the whole archive at once, its size is known from the file headers
+    if file_header_list:
+        last_file_header = file_header_list[-1]
+        _preallocate(archive.fileno(), last_file_header.file_offset + last_file_header.file_size
+                     + 4 * len(file_header_list) + len(CHECKSUMS_SIGNATURE))
+
+    # Write file signature
+    archive.write(FILE_SIGNATURE)
+
+    archive.write(b''.join(file_header.header_array for file_header in file_header_list))
+    checksum_list = []
+    # the files read through the page cache are read into the same buffer one after the other
+    copy_buffer = memoryview(bytearray(CHUNK_SIZE))
+    if direct:
+        for file_header, path in zip(file_header_list, file_path_list):
+            try:
+                checksum_list.append(_copy_file_contents_direct(path, archive, file_header.file_size, copy_buffer))
+            except EOFError:
+                raise ResourceChangedError(path)
+    else:
+        for file_header, path, file in zip(file_header_list, file_path_list, _open_with_readahead(file_path_list)):
+            with file:
+                try:
+                    checksum_list.append(_copy_file_contents(file, archive, file_header.file_size, copy_buffer))
+                except EOFError:
+                    raise ResourceChangedError(path)
+
+    # Write checksums table, an archive of no files is only the file signature
+    if checksum_list:
+        archive.write(struct.pack(f'<{len(checksum_list)}I', *checksum_list) + CHECKSUMS_SIGNATURE)
+
+
+def _resolve_renaming(renaming: Iterable[Tuple[Union[int, str], str]],
+                      file_header_list: List[FileHeader]) -> Dict[str, str]:
+    """Internal function.
+
+    Used when unpacking an archive, maps the original file paths to the new ones. Files can be given by their path
+    or by their index in the archive, indexes not in the archive being ignored like paths not in the archive.
+
+    :param renaming: Tuples of the form (old file name in archive or its index, new file name).
+    :param file_header_list: Sorted file headers of the archive.
+    :return: Dictionary from old file names to new file names.
+    """
+    resolved_renaming = {}
+    for original_name, changed_name in renaming:
+        if isinstance(original_name, int):
+            if not 0 <= original_name < len(file_header_list):
+                continue
+            original_name = file_header_list[original_name].file_path
+        resolved_renaming[original_name] = changed_name
+    return resolved_renaming
 
 
 def _header_list_from_archive(archive_path: Union[str, bytes, PathLike]) -> List[FileHeader]:
     """Internal function.
 
-    Used for unpacking archives and getting information about the files in the archives.
+    Used for unpacking archives and getting information about the files in the archives. The file headers of the
+    last HEADER_CACHE_SIZE archives read are kept in memory, an archive modified since it was read is read again.
 
     :param archive_path: Path to the archive.
-    :return: List of file headers.
+    :return: List of file headers, which must not be modified as they are shared with later calls.
     """
-    if not Path(archive_path).exists():
+    try:
+        archive_stat = os.stat(archive_path)
+    except (FileNotFoundError, NotADirectoryError):
         raise ArchiveNonExistentError(archive_path)
+    return list(_read_header_list(os.path.realpath(archive_path), archive_stat.st_mtime_ns, archive_stat.st_size))
 
-    file_header_list = []
-    with open(archive_path, 'rb') as archive:
+
+@functools.lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _read_header_list(archive_path: str,
+                      archive_mtime_ns: int,
+                      archive_size: int) -> Tuple[FileHeader, ...]:
+    """Internal function.
+
+    Used for getting the file headers of an archive, reads them from the archive. If the archive ends with a
+    checksums table, the checksums are set on the file headers. The modification time and size of the archive
+    are only part of the key under which the result is cached.
+
+    :param archive_path: Resolved path to the archive.
+    :param archive_mtime_ns: Time of the last modification of the archive, in nanoseconds.
+    :param archive_size: Size of the archive.
+    :return: Tuple of file headers.
+    """
+    try:
+        archive = open(archive_path, 'rb')
+    except (FileNotFoundError, NotADirectoryError):
+        raise ArchiveNonExistentError(archive_path)
+
+    with archive:
         # Check for file signature
         if archive.read(len(FILE_SIGNATURE)) != FILE_SIGNATURE:
             raise ArchiveNotRecognizableError(archive_path)
 
-        file_header = FileHeader.from_archive(archive)
-        file_header_list.append(file_header)
-        header_list_sentinel = file_header.file_offset
+        # the size may have changed since the archive was stat'ed for the cache key
+        archive_size = os.fstat(archive.fileno()).st_size
+        if archive_size == len(FILE_SIGNATURE):
+            # Archive of no files
+            return ()
+
+        try:
+            first_file_header = FileHeader.from_archive(archive)
+        except (EOFError, UnicodeDecodeError):
+            raise ArchiveCorruptedError(archive_path)
+        # The headers region ends where the contents of the first file start
+        header_region_start = len(FILE_SIGNATURE) + first_file_header.header_size
+        header_region_end = first_file_header.file_offset
+        if not header_region_start <= header_region_end <= archive_size:
+            raise ArchiveCorruptedError(archive_path)
+        header_region = memoryview(archive.read(header_region_end - header_region_start))
+
+        try:
+            file_header_list = [first_file_header] + FileHeader.list_from_buffer(header_region)
+        except (EOFError, UnicodeDecodeError):
+            raise ArchiveCorruptedError(archive_path)
+
+        for file_header in file_header_list:
+            if not header_region_end <= file_header.file_offset <= archive_size - file_header.file_size:
+                raise ArchiveCorruptedError(archive_path)
 
-        current_seek = archive.seek(file_header.header_size, os.SEEK_CUR)
-        while current_seek < header_list_sentinel:
-            file_header = FileHeader.from_archive(archive)
-            file_header_list.append(file_header)
-            current_seek = archive.seek(file_header.header_size, os.SEEK_CUR)
+        # The checksums table follows the contents of the last file, archives without checksums end right there
+        contents_end = max(file_header.file_offset + file_header.file_size for file_header in file_header_list)
+        checksums_table_size = 4 * len(file_header_list) + len(CHECKSUMS_SIGNATURE)
+        if archive_size == contents_end + checksums_table_size:
+            archive.seek(contents_end, os.SEEK_SET)
+            checksums_table = archive.read(checksums_table_size)
+            if checksums_table.endswith(CHECKSUMS_SIGNATURE):
+                checksum_list = struct.unpack_from(f'<{len(file_header_list)}I', checksums_table)
+                for file_header, checksum in zip(file_header_list, checksum_list):
+                    file_header.file_checksum = checksum
 
-    file_header_list.sort(key=lambda fh: fh.file_path)
-    return file_header_list
+    file_header_list.sort(key=attrgetter('file_path'))
+    return tuple(file_header_list)
 
 
-def _header_path_list_from_paths(*paths: Union[str, bytes, PathLike],
-                                 depth: int = 0) -> Tuple[List[FileHeader], List[Union[str, bytes, PathLike]]]:
+def _header_path_list_from_paths(*paths: Union[str, bytes, PathLike]) -> Tuple[List[FileHeader], List[str]]:
     """Internal function.
 
-    Used for packing files into an archive, the function parses directories and creates a list of file headers.
+    Used for packing files into an archive, the function walks through directories and creates a list of file headers.
 
     :param paths: Paths argument passed to the pack function.
-    :param depth: Should be 0 when called, used for going through directories.
     :return: 2-tuple containing list of file headers and list of paths to files.
     """
     file_header_list = []
     file_path_list = []
     for path in paths:
-        path = Path(os.path.abspath(path))
-        if not path.exists():
-            raise ResourceNonExistentError(str(path))
+        # bytes paths are decoded so that the walk and the archive name check only see str paths
+        path = os.fsdecode(os.path.abspath(path))
+        try:
+            path_stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            raise ResourceNonExistentError(path)
+
+        if stat.S_ISREG(path_stat.st_mode):
+            file_header_list.append(FileHeader.from_file(path, file_stat=path_stat))
+            file_path_list.append(path)
+        elif stat.S_ISDIR(path_stat.st_mode):
+            _walk_directory(path, file_header_list, file_path_list)
         else:
-            if path.is_file():
-                file_header_list.append(FileHeader.from_file(path, depth=depth))
-                file_path_list.append(path)
-            elif path.is_dir():
-                directory_file_header_list, directory_file_path_list = \
-                    _header_path_list_from_paths(*path.iterdir(), depth=depth + 1)
-                file_header_list.extend(directory_file_header_list)
-                file_path_list.extend(directory_file_path_list)
-            else:
-                raise ResourceCantBeArchivedError(str(path))
+            raise ResourceCantBeArchivedError(path)
 
-    if depth == 0:
-        current_offset = len(FILE_SIGNATURE) + sum(map(lambda header: header.header_size, file_header_list))
-        for file_header in file_header_list:
-            file_header.file_offset = current_offset
-            current_offset += file_header.file_size
+    # Store the files in the order in which they are listed, so sorting their headers when reading them is cheap
+    sorted_pair_list = sorted(zip(file_header_list, file_path_list), key=lambda pair: pair[0].file_path)
+    file_header_list = []
+    file_path_list = []
+    header_region_size = 0
+    for file_header, file_path in sorted_pair_list:
+        file_header_list.append(file_header)
+        file_path_list.append(file_path)
+        header_region_size += file_header.header_size
+
+    # The contents of the files follow the headers region
+    current_offset = len(FILE_SIGNATURE) + header_region_size
+    for file_header in file_header_list:
+        file_header.file_offset = current_offset
+        current_offset += file_header.file_size
     return file_header_list, file_path_list
 
 
+def _walk_directory(directory_path: str,
+                    file_header_list: List[FileHeader],
+                    file_path_list: List[str]) -> None:
+    """Internal function.
+
+    Used for packing a directory into an archive, walks through the directory tree breadth first and appends the file
+    headers and paths of the files found to the given lists. Once more than WALK_CONCURRENCY_THRESHOLD directories
+    are waiting to be scanned, they are scanned by a pool of threads, overlapping the waits on the file system.
+    The results are gathered in the order of the walk, so the files are in the same order either way.
+
+    :param directory_path: Absolute path to the directory.
+    :param file_header_list: List where the file headers are appended.
+    :param file_path_list: List where the paths to the files are appended.
+    """
+    def gather(scan_result: Tuple[List[str], List[FileHeader], List[str]]) -> List[str]:
+        subdirectory_path_list, scanned_file_header_list, scanned_file_path_list = scan_result
+        file_header_list.extend(scanned_file_header_list)
+        file_path_list.extend(scanned_file_path_list)
+        return subdirectory_path_list
+
+    relative_start = len(os.path.join(os.path.dirname(directory_path), ''))
+    directory_queue = deque([directory_path])
+    while directory_queue and len(directory_queue) <= WALK_CONCURRENCY_THRESHOLD:
+        directory_queue.extend(gather(_scan_directory(directory_queue.popleft(), relative_start)))
+    if not directory_queue:
+        return
+
+    with ThreadPoolExecutor(max_workers=WALK_MAX_WORKERS) as executor:
+        future_queue = deque(executor.submit(_scan_directory, directory_path, relative_start)
+                             for directory_path in directory_queue)
+        try:
+            while future_queue:
+                for subdirectory_path in gather(future_queue.popleft().result()):
+                    future_queue.append(executor.submit(_scan_directory, subdirectory_path, relative_start))
+        finally:
+            for future in future_queue:
+                future.cancel()
+
+
+def _scan_directory(directory_path: str,
+                    relative_start: int) -> Tuple[List[str], List[FileHeader], List[str]]:
+    """Internal function.
+
+    Used when walking through a directory tree, scans a directory with os.scandir and creates the file headers of
+    the files in it. The file paths in the headers are the paths of the files starting at *relative_start*.
+
+    :param directory_path: Absolute path to the directory.
+    :param relative_start: Index in the paths of the files where the paths kept in the archive start.
+    :return: 3-tuple containing list of paths to subdirectories, list of file headers and list of paths to files.
+    """
+    subdirectory_path_list = []
+    file_header_list = []
+    file_path_list = []
+    with os.scandir(directory_path) as directory_entries:
+        for entry in directory_entries:
+            if entry.is_dir():
+                subdirectory_path_list.append(entry.path)
+            elif entry.is_file():
+                file_header_list.append(FileHeader.from_file(entry.path, entry.path[relative_start:], entry.stat()))
+                file_path_list.append(entry.path)
+            elif not os.path.exists(entry.path):
+                raise ResourceNonExistentError(entry.path)
+            else:
+                raise ResourceCantBeArchivedError(entry.path)
+    return subdirectory_path_list, file_header_list, file_path_list
+
+
+def _resolve_direct(direct: bool) -> bool:
+    """Internal function.
+
+    Used for packing and unpacking, checks whether direct I/O can be used when it is requested.
+
+    :param direct: Whether direct I/O is requested.
+    :return: Whether direct I/O will be used.
+    """
+    if direct and not directio.is_supported():
+        logger.warning('direct I/O is not supported on this platform, using the page cache')
+        return False
+    return direct
+
+
+def _preallocate(fd: int,
+                 size: int) -> None:
+    """Internal function.
+
+    Used for writing files of known size, reserves the space of the file on disk in one go, so that the file system
+    doesn't extend the file with every write and can give it contiguous space. Does nothing on platforms without
+    os.posix_fallocate or on file systems that don't support it.
+
+    :param fd: File descriptor of the file.
+    :param size: Size of the file.
+    """
+    if hasattr(os, 'posix_fallocate') and size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as error:
+            if error.errno not in (errno.EINVAL, errno.EOPNOTSUPP, errno.ENOSYS):
+                raise
+
+
 def _create_destination_path(destination_path: Union[str, bytes, PathLike]) -> None:
     """Internal function.
 
@@ -180,40 +494,364 @@ def _create_destination_path(destination_path: Union[str, bytes, PathLike]) -> N
     destination_path = Path(destination_path)
     if not destination_path.exists():
         destination_path.mkdir(parents=True)
-        logging.info(f'created destination_path: {destination_path}')
+        logger.info('created destination_path: %s', destination_path)
+
+
+def _create_directories(destination_path: Path,
+                        file_header_list: List[FileHeader]) -> None:
+    """Internal function.
+
+    Used when unpacking an archive, creates the directories of the files to unpack, relative to the destination
+    path, once for every directory. The files themselves are created when they are opened for writing.
+
+    :param destination_path: Path to directory where to unpack.
+    :param file_header_list: File headers of the files to unpack.
+    """
+    directory_path_set = {os.path.dirname(file_header.file_path) for file_header in file_header_list}
+    directory_path_set.discard('')
+    log_directories = logger.isEnabledFor(logging.DEBUG)
+    for directory_path in sorted(directory_path_set):
+        os.makedirs(destination_path / directory_path, exist_ok=True)
+        if log_directories:
+            logger.debug('created directory: %s', destination_path / directory_path)
+
+
+def _open_direct_archive(archive_path: Union[str, bytes, PathLike],
+                         direct: bool) -> ContextManager[Optional[BinaryIO]]:
+    """Internal function.
+
+    Used when unpacking an archive, opens the archive with direct I/O for reading the contents of the files of at
+    least DIRECT_MIN_FILE_SIZE bytes, next to the archive file object used for the smaller files.
 
+    :param archive_path: Path to the archive.
+    :param direct: Whether to use direct I/O.
+    :return: Archive file object opened with direct I/O, or a context manager giving None without direct I/O.
+    """
+    return directio.open_for_reading(archive_path) if direct else contextlib.nullcontext()
 
-def _create_file_path(file_path: Union[str, bytes, PathLike]) -> None:
-    """Internal function
 
-    Used when unpacking an archive, creates the path to the file.
+def _unpack_files_concurrently(file_header_list: List[FileHeader],
+                               archive_file_object: BinaryIO,
+                               destination_path: Path,
+                               direct_archive_file_object: Optional[BinaryIO],
+                               verify: bool) -> None:
+    """Internal function.
+
+    Used when unpacking an archive, extracts the files using a pool of threads. The files occupy disjoint parts of
+    the archive and have different paths, so they can be extracted independently. The archive is only read at
+    explicit offsets, never moving the position of the file object, so the threads share it. The files are handed
+    to the threads in the order of the archive with at most READAHEAD_DEPTH of them waiting, the contents of the
+    next files being requested from the kernel as they are handed over, like when unpacking without threads.
 
-    :param file_path: Path to the file to be created.
+    :param file_header_list: File headers of the files to unpack, sorted by their offsets.
+    :param archive_file_object: Archive file object.
+    :param destination_path: Path to directory where to unpack.
+    :param direct_archive_file_object: Archive file object opened with direct I/O, None without direct I/O.
+    :param verify: Whether to verify the checksums of the files.
     """
-    file_path = Path(file_path)
-    if not file_path.exists():
-        if not file_path.parent.exists():
-            file_path.parent.mkdir(parents=True)
-            logging.info(f'created file_path.parent: {file_path.parent}')
-        file_path.touch()
-        logging.info(f'touched file_path: {file_path}')
+    with ThreadPoolExecutor(max_workers=min(UNPACK_MAX_WORKERS, len(file_header_list))) as executor:
+        # reading ahead would fill the page cache that direct I/O bypasses
+        file_header_iterator = iter(file_header_list)
+        if direct_archive_file_object is None:
+            file_header_iterator = _with_archive_readahead(archive_file_object, file_header_list)
+        future_set = set()
+        try:
+            for file_header in file_header_iterator:
+                if len(future_set) >= READAHEAD_DEPTH:
+                    done_future_set, future_set = wait(future_set, return_when=FIRST_COMPLETED)
+                    for future in done_future_set:
+                        future.result()
+                future_set.add(executor.submit(_unpack_file, file_header, archive_file_object, destination_path,
+                                               direct_archive_file_object, verify))
+            done_future_set, future_set = wait(future_set, return_when=FIRST_EXCEPTION)
+            for future in done_future_set:
+                future.result()
+        finally:
+            for future in future_set:
+                future.cancel()
 
 
 def _unpack_file(file_header: FileHeader,
-                 archive_file_object: BinaryIO) -> None:
+                 archive_file_object: BinaryIO,
+                 destination_path: Path,
+                 direct_archive_file_object: Optional[BinaryIO] = None,
+                 verify: bool = True) -> None:
     """Internal function.
 
     Used when unpacking an archive, extracts the file from the archive into the path specified
-    in the file header.
+    in the file header, relative to the destination path.
 
     :param file_header: File's header from the archive.
     :param archive_file_object: Archive file object.
+    :param destination_path: Path to directory where to unpack.
+    :param direct_archive_file_object: Archive file object opened with direct I/O, used instead of
+     *archive_file_object* for files of at least DIRECT_MIN_FILE_SIZE bytes. None without direct I/O.
+    :param verify: Whether to verify the checksum of the file, if it has one.
+    :raises ArchiveCorruptedError: If the archive ends before the end of the file contents, e.g. when it was
+     truncated during the unpacking.
+    """
+    file_path = destination_path / file_header.file_path
+    verify = verify and file_header.file_checksum is not None
+    checksum = 0
+    direct = direct_archive_file_object is not None and file_header.file_size >= DIRECT_MIN_FILE_SIZE
+    logger.debug('writing file: %s', file_path)
+    file = directio.open_for_writing(file_path) if direct else open(file_path, 'wb')
+    with file:
+        # Reserve the space of files written in more than one chunk at once
+        if file_header.file_size > CHUNK_SIZE:
+            _preallocate(file.fileno(), file_header.file_size)
+
+        if direct:
+            bytes_copied = 0
+            for chunk in directio.iter_file_range(direct_archive_file_object, file_header.file_offset,
+                                                  file_header.file_size):
+                checksum = zlib.crc32(chunk, checksum)
+                file.write(chunk)
+                bytes_copied += len(chunk)
+            if bytes_copied < file_header.file_size:
+                raise ArchiveCorruptedError(archive_file_object.name)
+        else:
+            try:
+                # sendfile copies inside the kernel, where the checksum can't be computed
+                if verify or not _send_file_range(archive_file_object, file, file_header.file_offset,
+                                                  file_header.file_size):
+                    checksum = _copy_archive_range(archive_file_object, file, file_header.file_offset,
+                                                   file_header.file_size)
+            except EOFError:
+                raise ArchiveCorruptedError(archive_file_object.name)
+    if verify and checksum != file_header.file_checksum:
+        raise ChecksumMismatchError(file_path)
+    logger.debug('wrote file: %s', file_path)
+
+
+def _copy_file_contents_direct(file_path: str,
+                               destination_file_object: BinaryIO,
+                               count: int,
+                               copy_buffer: memoryview) -> int:
+    """Internal function.
+
+    Used when packing an archive with direct I/O, writes the first *count* bytes of the file to the destination
+    file, computing their checksum on the way. Files smaller than DIRECT_MIN_FILE_SIZE are read through the page
+    cache into *copy_buffer*, the others with direct I/O.
+
+    :param file_path: Path to the file.
+    :param destination_file_object: File object to copy to.
+    :param count: Number of bytes to copy.
+    :param copy_buffer: Buffer to read the small files into.
+    :return: CRC-32 checksum of the copied bytes.
+    :raises EOFError: If the file has less than *count* bytes.
+    """
+    if count < DIRECT_MIN_FILE_SIZE:
+        with open(file_path, 'rb', buffering=0) as file:
+            return _copy_file_contents(file, destination_file_object, count, copy_buffer)
+    checksum = 0
+    with directio.open_for_reading(file_path) as file:
+        for chunk in directio.iter_file_range(file, 0, count):
+            checksum = zlib.crc32(chunk, checksum)
+            destination_file_object.write(chunk)
+            count -= len(chunk)
+    if count > 0:
+        raise EOFError('file ended before its size in the header')
+    return checksum
+
+
+def _copy_file_contents(source_file_object: BinaryIO,
+                        destination_file_object: BinaryIO,
+                        count: int,
+                        copy_buffer: memoryview) -> int:
+    """Internal function.
+
+    Used when packing an archive, writes the first *count* bytes of the source file to the destination file,
+    computing their checksum on the way. The bytes are read into *copy_buffer* one chunk at a time, the chunks of
+    small files being gathered in the buffer of the destination file object. The file isn't memory mapped, since
+    another process truncating a mapped file would kill this one instead of making the read come up short.
+
+    :param source_file_object: File object to copy from.
+    :param destination_file_object: File object to copy to.
+    :param count: Number of bytes to copy.
+    :param copy_buffer: Buffer reused for reading the files.
+    :return: CRC-32 checksum of the copied bytes.
+    :raises EOFError: If the source file has less than *count* bytes.
+    """
+    checksum = 0
+    while count > 0:
+        chunk_size = source_file_object.readinto(copy_buffer[:min(count, len(copy_buffer))])
+        if not chunk_size:
+            raise EOFError('file ended before its size in the header')
+        chunk = copy_buffer[:chunk_size]
+        checksum = zlib.crc32(chunk, checksum)
+        destination_file_object.write(chunk)
+        count -= chunk_size
+    return checksum
+
+
+def _copy_archive_range(archive_file_object: BinaryIO,
+                        destination_file_object: BinaryIO,
+                        offset: int,
+                        count: int) -> int:
+    """Internal function.
+
+    Used when unpacking an archive, writes *count* bytes starting at *offset* in the archive to the current position
+    of the destination file, in chunks of CHUNK_SIZE, computing their checksum on the way. The archive is read at
+    explicit offsets and not memory mapped, so that an archive truncated by another process makes the read come up
+    short instead of killing this process.
+
+    :param archive_file_object: Archive file object.
+    :param destination_file_object: File object to copy to.
+    :param offset: Offset in the archive where the bytes to copy start.
+    :param count: Number of bytes to copy.
+    :return: CRC-32 checksum of the copied bytes.
+    :raises EOFError: If the archive ends before the end of the range.
+    """
+    # every call has its own buffer, so threads can copy at the same time
+    copy_buffer = memoryview(bytearray(min(count, CHUNK_SIZE)))
+    checksum = 0
+    while count > 0:
+        chunk_size = _read_at(archive_file_object, copy_buffer[:min(count, len(copy_buffer))], offset)
+        if not chunk_size:
+            raise EOFError('archive ended inside the contents of a file')
+        chunk = copy_buffer[:chunk_size]
+        checksum = zlib.crc32(chunk, checksum)
+        destination_file_object.write(chunk)
+        offset += chunk_size
+        count -= chunk_size
+    return checksum
+
+
+def _read_at(file_object: BinaryIO,
+             buffer: memoryview,
+             offset: int) -> int:
+    """Internal function.
+
+    Used for reading a file from several threads at once, reads into *buffer* from *offset* in the file without
+    moving the position of the file object, with os.preadv or os.pread. On platforms without them the position is
+    moved under a lock.
+
+    :param file_object: File object to read from.
+    :param buffer: Buffer to read into.
+    :param offset: Offset in the file where the read starts.
+    :return: Number of bytes read, 0 at the end of the file.
+    """
+    if hasattr(os, 'preadv'):
+        return os.preadv(file_object.fileno(), [buffer], offset)
+    if hasattr(os, 'pread'):
+        data = os.pread(file_object.fileno(), len(buffer), offset)
+        buffer[:len(data)] = data
+        return len(data)
+    with _SEEK_LOCK:
+        file_object.seek(offset)
+        return file_object.readinto(buffer)
+
+
+def _send_file_range(source_file_object: BinaryIO,
+                     destination_file_object: BinaryIO,
+                     offset: int,
+                     count: int) -> bool:
+    """Internal function.
+
+    Used when unpacking an archive, copies *count* bytes starting at *offset* in the source file to the current
+    position of the destination file, inside the kernel with os.copy_file_range, or os.sendfile if the file system
+    doesn't support it.
+
+    :param source_file_object: File object to copy from.
+    :param destination_file_object: File object to copy to.
+    :param offset: Offset in the source file where the bytes to copy start.
+    :param count: Number of bytes to copy.
+    :return: Whether the bytes were copied, False if sendfile can't be used for these files.
+    :raises EOFError: If the source file ends before the end of the range.
+    """
+    if not _USE_SENDFILE:
+        return False
+    # flush what was written through the file object before writing directly to the file descriptor
+    destination_file_object.flush()
+    source_fd, destination_fd = source_file_object.fileno(), destination_file_object.fileno()
+    use_copy_file_range = _USE_COPY_FILE_RANGE
+    copied = 0
+    while copied < count:
+        try:
+            if use_copy_file_range:
+                sent = os.copy_file_range(source_fd, destination_fd, count - copied, offset + copied)
+            else:
+                sent = os.sendfile(destination_fd, source_fd, offset + copied, count - copied)
+        except OSError as error:
+            # some file systems don't support copy_file_range or sendfile, or copying across file systems
+            if copied == 0 and error.errno in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                if use_copy_file_range:
+                    use_copy_file_range = False
+                    continue
+                return False
+            raise
+        if sent == 0:
+            raise EOFError('source file ended inside the range')
+        copied += sent
+    return True
+
+
+def _advise_will_need(fd: int,
+                      offset: int = 0,
+                      length: int = 0) -> None:
+    """Internal function.
+
+    Used for overlapping disk reads across files, tells the kernel that the given range of the file will be read
+    soon so it can start reading it asynchronously. Does nothing on platforms without os.posix_fadvise.
+
+    :param fd: File descriptor of the file.
+    :param offset: Offset where the range starts.
+    :param length: Length of the range, 0 meaning until the end of the file.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            # the advice is only a hint, the copy works the same without it
+            pass
+
+
+def _open_with_readahead(file_path_list: Iterable[Union[str, bytes, PathLike]]) -> Iterator[BinaryIO]:
+    """Internal function.
+
+    Used when packing an archive, opens the files in *file_path_list* in order while keeping up to READAHEAD_DEPTH
+    files opened ahead, with their reading already requested from the kernel.
+
+    :param file_path_list: Paths to the files to open.
+    :return: Iterator over the opened unbuffered file objects, which are closed by the caller.
+    """
+    pending_fd_queue = deque()
+    file_path_iterator = iter(file_path_list)
+    try:
+        for file_path in file_path_iterator:
+            fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            pending_fd_queue.append(fd)
+            _advise_will_need(fd)
+            if len(pending_fd_queue) >= READAHEAD_DEPTH:
+                yield open(pending_fd_queue.popleft(), 'rb', buffering=0)
+        while pending_fd_queue:
+            yield open(pending_fd_queue.popleft(), 'rb', buffering=0)
+    finally:
+        for fd in pending_fd_queue:
+            os.close(fd)
+
+
+def _with_archive_readahead(archive_file_object: BinaryIO,
+                            file_header_list: List[FileHeader]) -> Iterator[FileHeader]:
+    """Internal function.
+
+    Used when unpacking an archive, iterates over *file_header_list* while requesting from the kernel the contents
+    of the next READAHEAD_DEPTH files in the archive.
+
+    :param archive_file_object: Archive file object.
+    :param file_header_list: File headers of the files to unpack.
+    :return: Iterator over the file headers.
     """
-    logging.info(f'writing file: {file_header.file_path}')
-    with open(file_header.file_path, 'wb') as file:
-        archive_file_object.seek(file_header.file_offset, os.SEEK_SET)
-        bytes_to_read = file_header.file_size
-        while chunk := archive_file_object.read(min(CHUNK_SIZE, bytes_to_read)):
-            bytes_to_read -= min(CHUNK_SIZE, bytes_to_read)
-            file.write(chunk)
-    logging.info(f'wrote file: {file_header.file_path}')
+    def advise(advised_file_header: FileHeader) -> None:
+        # a length of 0 would advise the whole rest of the archive
+        if advised_file_header.file_size > 0:
+            _advise_will_need(archive_fd, advised_file_header.file_offset, advised_file_header.file_size)
+
+    archive_fd = archive_file_object.fileno()
+    for file_header in file_header_list[:READAHEAD_DEPTH]:
+        advise(file_header)
+    for index, file_header in enumerate(file_header_list):
+        if index + READAHEAD_DEPTH < len(file_header_list):
+            advise(file_header_list[index + READAHEAD_DEPTH])
+        yield file_header
@@ -0,0 +1,178 @@
+"""
+Contains helpers for direct I/O.
+
+Direct I/O moves file contents between the disk and an aligned user space buffer without going through
+the kernel page cache. For large files which are only copied once this avoids copying every byte through
+memory twice and evicting everything else from the page cache.
+"""
+
+from os import PathLike
+from typing import BinaryIO, Iterator, Union
+import errno
+import logging
+import mmap
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ALIGNMENT = 4096
+BUFFER_SIZE = 1 << 20
+
+
+def is_supported() -> bool:
+    """Check whether direct I/O is available on this platform."""
+    return hasattr(os, 'O_DIRECT') and hasattr(os, 'preadv') and fcntl is not None
+
+
+def open_for_reading(file_path: Union[str, bytes, PathLike]) -> BinaryIO:
+    """Open a file for reading with direct I/O.
+
+    If the file system doesn't support direct I/O the file is opened normally.
+
+    :param file_path: Path to the file.
+    :return: Unbuffered file object.
+    """
+    try:
+        fd = os.open(file_path, os.O_RDONLY | os.O_DIRECT)
+    except OSError as error:
+        if error.errno != errno.EINVAL:
+            raise
+        logger.info('direct I/O not supported for %s, reading through the page cache', file_path)
+        fd = os.open(file_path, os.O_RDONLY)
+    return open(fd, 'rb', buffering=0)
+
+
+def open_for_writing(file_path: Union[str, bytes, PathLike]) -> Union['DirectWriter', BinaryIO]:
+    """Open a file for writing with direct I/O.
+
+    If the file system doesn't support direct I/O the file is opened normally.
+
+    :param file_path: Path to the file.
+    :return: DirectWriter object or file object.
+    """
+    try:
+        return DirectWriter(file_path)
+    except OSError as error:
+        if error.errno != errno.EINVAL:
+            raise
+        logger.info('direct I/O not supported for %s, writing through the page cache', file_path)
+        return open(file_path, 'wb')
+
+
+def iter_file_range(file_object: BinaryIO,
+                    offset: int,
+                    count: int) -> Iterator[memoryview]:
+    """Read a range of a file in chunks.
+
+    The reads are done into an aligned buffer at aligned offsets, as required by direct I/O, and only the
+    requested part of what was read is returned. Every read is of at most BUFFER_SIZE bytes, only as many aligned
+    blocks as needed for the rest of the range. A chunk is only valid until the next one is requested.
+
+    :param file_object: File object returned by open_for_reading.
+    :param offset: Offset in the file where the range starts.
+    :param count: Number of bytes in the range.
+    :return: Iterator over memoryview objects holding consecutive parts of the range.
+    """
+    if count <= 0:
+        return
+    fd = file_object.fileno()
+    position = offset - offset % ALIGNMENT
+    skip = offset - position
+    buffer = mmap.mmap(-1, min(BUFFER_SIZE, _round_up(skip + count)))
+    buffer_view = memoryview(buffer)
+    while count > 0:
+        read_size = min(len(buffer), _round_up(skip + count))
+        bytes_read = os.preadv(fd, [buffer_view[:read_size]], position)
+        if bytes_read <= skip:
+            return
+        chunk_size = min(bytes_read - skip, count)
+        yield buffer_view[skip:skip + chunk_size]
+        if bytes_read < read_size:
+            # end of file reached
+            return
+        count -= chunk_size
+        position += bytes_read
+        skip = 0
+
+
+def _round_up(size: int) -> int:
+    """Internal function.
+
+    Rounds *size* up to a multiple of ALIGNMENT.
+    """
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+class DirectWriter:
+    """Writer for a file opened with direct I/O.
+
+    Direct I/O only accepts writes of aligned size, at aligned offsets, from aligned memory. The written data
+    is gathered in an aligned buffer which is written to the file whenever it fills up. The unaligned tail
+    left when closing the writer is written after turning direct I/O off for the file.
+    """
+
+    def __init__(self, file_path: Union[str, bytes, PathLike]):
+        """Create a DirectWriter object.
+
+        Truncates the file, or creates it if it doesn't exist.
+
+        :param file_path: Path to the file.
+        """
+        self._fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o666)
+        self._buffer = mmap.mmap(-1, BUFFER_SIZE)
+        self._buffered = 0
+
+    def __enter__(self) -> 'DirectWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def fileno(self) -> int:
+        """Get the file descriptor of the file."""
+        return self._fd
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        """Write data to the file.
+
+        :param data: Bytes-like object to write.
+        :return: Number of bytes written.
+        """
+        with memoryview(data) as data_view:
+            written = 0
+            while written < len(data_view):
+                chunk_size = min(BUFFER_SIZE - self._buffered, len(data_view) - written)
+                self._buffer[self._buffered:self._buffered + chunk_size] = data_view[written:written + chunk_size]
+                self._buffered += chunk_size
+                written += chunk_size
+                if self._buffered == BUFFER_SIZE:
+                    self._write_buffer(0, BUFFER_SIZE)
+                    self._buffered = 0
+        return written
+
+    def close(self) -> None:
+        """Write what is left in the buffer and close the file."""
+        if self._fd < 0:
+            return
+        try:
+            aligned_size = self._buffered - self._buffered % ALIGNMENT
+            self._write_buffer(0, aligned_size)
+            if aligned_size < self._buffered:
+                flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+                fcntl.fcntl(self._fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+                self._write_buffer(aligned_size, self._buffered)
+        finally:
+            os.close(self._fd)
+            self._fd = -1
+            self._buffer.close()
+
+    def _write_buffer(self, start: int, end: int) -> None:
+        """Write the part of the buffer between *start* and *end* to the file."""
+        with memoryview(self._buffer) as buffer_view:
+            while start < end:
+                start += os.write(self._fd, buffer_view[start:end])
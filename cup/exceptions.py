@@ -19,7 +19,7 @@ class ArchiveAlreadyExistsError(CupException):
     """
 
     def __init__(self, archive_path):
-        super().__init__(f"Archive output file already exists: {os.path.abspath(archive_path)}")
+        super().__init__(f"Archive output file already exists: {os.fsdecode(os.path.abspath(archive_path))}")
 
 
 class ResourceNonExistentError(CupException):
@@ -36,6 +36,13 @@ class ResourceCantBeArchivedError(CupException):
         super().__init__(f"Resource is not a file/directory: {resource_path}")
 
 
+class ResourceChangedError(CupException):
+    """Raise error when a file to archive gets shorter between listing it and copying its contents."""
+
+    def __init__(self, resource_path):
+        super().__init__(f"Resource changed while being archived: {resource_path}")
+
+
 class ArchiveNonExistentError(CupException):
     """Raise error when path to archive doesn't exist."""
 
@@ -48,3 +55,20 @@ class ArchiveNotRecognizableError(CupException):
 
     def __init__(self, archive_path):
         super().__init__(f"File is not a Cup archive: {archive_path}")
+
+
+class ArchiveCorruptedError(CupException):
+    """Raise error when the file headers of an archive don't fit inside the archive.
+
+    For example, when the archive has been truncated, the headers region or the contents of some files are missing.
+    """
+
+    def __init__(self, archive_path):
+        super().__init__(f"Archive is corrupted: {archive_path}")
+
+
+class ChecksumMismatchError(CupException):
+    """Raise error when the contents of an unpacked file don't match the checksum stored in the archive."""
+
+    def __init__(self, file_path):
+        super().__init__(f"File contents don't match their checksum: {file_path}")
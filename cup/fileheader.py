@@ -1,16 +1,12 @@
 """Contains the FileHeader class."""
 
 import os
+import struct
 from os import PathLike
-from pathlib import Path
-from typing import BinaryIO, Union
+from typing import BinaryIO, List, Optional, Union
 
-BYTES_FOR = {
-    'offset': 8,
-    'timestamp': 4,
-    'file_size': 4,
-    'file_path_length': 2,
-}
+# Offset, timestamp, file size and file path length, in little endian order
+FIXED_FIELDS = struct.Struct('<QIIH')
 
 
 class FileHeader:
@@ -24,142 +20,135 @@ class FileHeader:
     - 4 bytes: UNIX timestamp of the time of the last modification.
     - 4 bytes: file size.
     - 2 bytes: the length of the file path.
-    - *n* bytes: the path of the file, where the characters are ASCII encoded.
-    """
-
-    def __init__(self):
-        """Create a FileHeader object.
+    - *n* bytes: the path of the file, UTF-8 encoded.
 
-        Initialises header_array as empty bytearray in order to get type hints.
-        """
-        self.header_array = bytearray()
-
-    @property
-    def header_size(self) -> int:
-        """Get the length of the header."""
-        return len(self.header_array)
-
-    @property
-    def file_offset(self) -> int:
-        """Get the file offset where the file contents are found."""
-        return int.from_bytes(self.header_array[0:8], 'little')
-
-    @file_offset.setter
-    def file_offset(self, offset: int) -> None:
-        """Set the offset where the file contents are found."""
-        offset_bytes = offset.to_bytes(BYTES_FOR['offset'], 'little')
-        self.header_array[0:8] = offset_bytes
+    The CRC-32 checksum of the file contents isn't part of the header, it is stored in the checksums table at the
+    end of the archive and kept in *file_checksum*, which is None for archives without checksums.
+    """
 
-    @property
-    def file_timestamp(self) -> int:
-        """Get the file time of last modification."""
-        return int.from_bytes(self.header_array[8:12], 'little')
+    __slots__ = ('file_offset', 'file_timestamp', 'file_size', 'file_path', 'header_size', 'file_checksum')
 
-    @file_timestamp.setter
-    def file_timestamp(self, timestamp: float) -> None:
-        """Set the file time of last modification."""
-        # timestamp is float, convert it to int
-        timestamp = int(timestamp)
-        timestamp_bytes = timestamp.to_bytes(BYTES_FOR['timestamp'], 'little')
-        self.header_array[8:12] = timestamp_bytes
+    def __init__(self,
+                 file_offset: int = 0,
+                 file_timestamp: int = 0,
+                 file_size: int = 0,
+                 file_path: str = '',
+                 header_size: Optional[int] = None,
+                 file_checksum: Optional[int] = None):
+        """Create a FileHeader object.
 
-    @property
-    def file_size(self) -> int:
-        """Get the size of the file."""
-        return int.from_bytes(self.header_array[12:16], 'little')
+        The fields of the header are kept decoded, the bytes of the header are only built when writing it.
 
-    @file_size.setter
-    def file_size(self, file_size: int) -> None:
-        """Set the size of the file."""
-        file_size_bytes = file_size.to_bytes(BYTES_FOR['file_size'], 'little')
-        self.header_array[12:16] = file_size_bytes
+        :param file_offset: Offset where the file contents are found.
+        :param file_timestamp: UNIX timestamp of the time of the last modification.
+        :param file_size: Size of the file.
+        :param file_path: Path of the file.
+        :param header_size: Length of the header if already known, to avoid encoding the file path again.
+        :param file_checksum: CRC-32 checksum of the file contents, None if not known.
+        """
+        self.file_offset = file_offset
+        self.file_timestamp = file_timestamp
+        self.file_size = file_size
+        self.file_path = file_path
+        if header_size is None:
+            header_size = FIXED_FIELDS.size + len(file_path.encode())
+        self.header_size = header_size
+        self.file_checksum = file_checksum
 
     @property
     def file_path_length(self) -> int:
         """Get the file path length."""
-        return int.from_bytes(self.header_array[16:18], 'little')
-
-    @file_path_length.setter
-    def file_path_length(self, file_path_length: int) -> None:
-        """Set the file path length."""
-        file_path_length_bytes = file_path_length.to_bytes(BYTES_FOR['file_path_length'], 'little')
-        self.header_array[16:18] = file_path_length_bytes
+        return self.header_size - FIXED_FIELDS.size
 
     @property
-    def file_path(self) -> str:
-        """Get the file path."""
-        return self.header_array[18:18 + self.file_path_length].decode()
-
-    @file_path.setter
-    def file_path(self, file_path) -> None:
-        """Set the file path."""
-        file_path = str(file_path)
-        bytes_for_file_path = len(file_path)
-        self.header_array[18:18 + bytes_for_file_path] = file_path.encode()
+    def header_array(self) -> bytes:
+        """Get the bytes of the header."""
+        file_path = self.file_path.encode()
+        return FIXED_FIELDS.pack(self.file_offset, self.file_timestamp, self.file_size, len(file_path)) + file_path
 
     def with_different_path(self, new_file_path: Union[str, bytes, PathLike]) -> 'FileHeader':
         """Create FileHeader object with different file path.
 
         Used for performing file renaming when unpacking an archive. The *new_file_path* argument specifies what the new
         FileHeader's file path will be. The *FileHeader* object on which this method is called is not modified, instead
-        this function returns a copy of that object only with the *file_path_length* and *file_path* properties modified.
+        this function returns a copy of that object only with the *file_path* and *header_size* attributes different.
 
         :param new_file_path: The new file path to be used.
         :return: FileHeader object with different file path.
         """
-        file_header = FileHeader()
-        header_array_size = sum(BYTES_FOR.values()) + len(str(new_file_path))
-        file_header.header_array = bytearray(header_array_size)
-        file_header.header_array[0:sum(BYTES_FOR.values())] = self.header_array[0:sum(BYTES_FOR.values())]
-        file_header.file_path_length = len(str(new_file_path))
-        file_header.file_path = new_file_path
-        return file_header
+        return FileHeader(self.file_offset,
+                          self.file_timestamp,
+                          self.file_size,
+                          os.fsdecode(new_file_path),
+                          file_checksum=self.file_checksum)
 
     @staticmethod
-    def from_archive(archive: BinaryIO,
-                     header_position: int = 0) -> 'FileHeader':
+    def from_archive(archive: BinaryIO) -> 'FileHeader':
         """Create FileHeader object from archive.
 
-        Used for getting information about a file in the archive and unpacking it.
+        Used for getting information about a file in the archive and unpacking it. The header is read from the
+        current position of the archive file object, which is left right after the header.
 
         :param archive: The archive file object.
-        :param header_position: The header position relative to the beginning of the archive file.
         :return: FileHeader object.
+        :raises EOFError: If the archive ends before the end of the header.
+        :raises UnicodeDecodeError: If the file path isn't valid UTF-8.
         """
-        original_seek = archive.seek(0, os.SEEK_CUR)
+        fixed_fields = archive.read(FIXED_FIELDS.size)
+        if len(fixed_fields) < FIXED_FIELDS.size:
+            raise EOFError('archive ended inside a file header')
+        offset, timestamp, file_size, file_path_length = FIXED_FIELDS.unpack(fixed_fields)
+        file_path = archive.read(file_path_length)
+        if len(file_path) < file_path_length:
+            raise EOFError('archive ended inside a file header')
+        return FileHeader(offset, timestamp, file_size, file_path.decode(), FIXED_FIELDS.size + file_path_length)
 
-        file_header = FileHeader()
-        archive.seek(header_position + 16, os.SEEK_CUR)
-        bytes_for_file_path = int.from_bytes(archive.read(2), 'little')
-        archive.seek(original_seek, os.SEEK_SET)
-        header_size = sum(BYTES_FOR.values()) + bytes_for_file_path
-        file_header.header_array = bytearray(archive.read(header_size))
+    @staticmethod
+    def list_from_buffer(buffer: Union[bytes, bytearray, memoryview]) -> List['FileHeader']:
+        """Create FileHeader objects from a buffer of consecutive headers.
 
-        archive.seek(original_seek, os.SEEK_SET)
-        return file_header
+        Used for getting the file headers out of the headers region of an archive, read at once into memory.
+        The fields decoded for finding the end of every header are kept on the created objects.
+
+        :param buffer: Bytes-like object holding file headers.
+        :return: List of FileHeader objects, in the order of the headers in the buffer.
+        :raises EOFError: If the buffer ends inside a header.
+        :raises UnicodeDecodeError: If a file path isn't valid UTF-8.
+        """
+        file_header_list = []
+        unpack_from = FIXED_FIELDS.unpack_from
+        buffer_size = len(buffer)
+        header_position = 0
+        while header_position < buffer_size:
+            if header_position + FIXED_FIELDS.size > buffer_size:
+                raise EOFError('buffer ended inside a file header')
+            offset, timestamp, file_size, file_path_length = unpack_from(buffer, header_position)
+            file_path_start = header_position + FIXED_FIELDS.size
+            header_end = file_path_start + file_path_length
+            if header_end > buffer_size:
+                raise EOFError('buffer ended inside a file header')
+
+            file_path = str(buffer[file_path_start:header_end], 'utf-8')
+            file_header_list.append(FileHeader(offset, timestamp, file_size, file_path, header_end - header_position))
+            header_position = header_end
+        return file_header_list
 
     @staticmethod
     def from_file(file_path: Union[str, bytes, PathLike],
-                  depth: int = 0) -> 'FileHeader':
+                  relative_file_path: Optional[str] = None,
+                  file_stat: Optional[os.stat_result] = None) -> 'FileHeader':
         """Create FileHeader object from file.
 
         Used for packing a file into an archive.
 
         :param file_path: Path to file.
-        :param depth: Should be 0 when called, used for going through directories.
+        :param relative_file_path: Path of the file kept in the archive, the name of the file if not given.
+        :param file_stat: Result of stat for the file if already known, to avoid calling stat again.
         :return: FileHeader object.
         """
-        file_path = Path(file_path)
-        file_path_relative = file_path.name
-        if depth > 0:
-            for directory in reversed(file_path.parts[-depth - 1:-1]):
-                file_path_relative = Path(directory) / file_path_relative
-
-        file_header = FileHeader()
-        header_array_size = sum(BYTES_FOR.values()) + len(str(file_path_relative))
-        file_header.header_array = bytearray(header_array_size)
-        file_header.file_timestamp = file_path.stat().st_mtime
-        file_header.file_size = file_path.stat().st_size
-        file_header.file_path_length = len(str(file_path_relative))
-        file_header.file_path = file_path_relative
-        return file_header
+        if relative_file_path is None:
+            relative_file_path = os.fsdecode(os.path.basename(file_path))
+        if file_stat is None:
+            file_stat = os.stat(file_path)
+        # timestamp is float, convert it to int
+        return FileHeader(0, int(file_stat.st_mtime), file_stat.st_size, relative_file_path)